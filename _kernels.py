@@ -0,0 +1,127 @@
+# Module for the numeric kernels used by the portfolio object. Importable without numba; run directly to AOT-compile them into the dca_kernels extension module.
+
+import numpy as np
+
+# schedule actions understood by run_schedule
+DEPOSIT = 0
+BUY = 1
+SELL = 2
+MAX_BUY = 3
+VALUE_BUY = 4
+ACTIONS = (DEPOSIT, BUY, SELL, MAX_BUY, VALUE_BUY)
+
+
+def simulate_dca(price_matrix, schedule_idxs, symbol_idx, deposit, cash, shares, cost_basis, avg_cost):
+    """Deposits and purchases the maximum number of shares of one symbol at every scheduled row, returning the remaining cash."""
+
+    for i in schedule_idxs:
+        cash += deposit
+
+        price = price_matrix[i, symbol_idx]
+        quantity = int(cash // price)
+        cost = price * quantity
+
+        if cash >= cost:
+            shares[symbol_idx] += quantity
+            cost_basis[symbol_idx] += cost
+            cash -= cost
+
+            if shares[symbol_idx] > 0:
+                avg_cost[symbol_idx] = cost_basis[symbol_idx] / shares[symbol_idx]
+
+    return cash
+
+
+def rebalance(prices, held, weight_cost, cash, shares, cost_basis, avg_cost):
+    """Sells every holding down to weight_cost and buys the rest up to it, returning the remaining cash."""
+
+    buy_qty = np.zeros(held.shape[0], dtype=np.int64)
+
+    # holdings with room for an additional share or more are queued for purchase, the rest are sold down to weight_cost
+    for k in range(held.shape[0]):
+        i = held[k]
+        price = prices[i]
+        value = price * shares[i]
+
+        if value + price <= weight_cost:
+            buy_qty[k] = int((weight_cost - value) / price)
+        else:
+            quantity = int((value - weight_cost) / price)
+            if quantity > 0:
+                shares[i] -= quantity
+                cost_basis[i] -= avg_cost[i] * quantity
+                cash += price * quantity
+
+    # purchases are done after selling off extra shares to ensure there is enough cash available
+    for k in range(held.shape[0]):
+        i = held[k]
+        quantity = buy_qty[k]
+        cost = prices[i] * quantity
+
+        if quantity > 0 and cash >= cost:
+            shares[i] += quantity
+            cost_basis[i] += cost
+            cash -= cost
+            avg_cost[i] = cost_basis[i] / shares[i]
+
+    return cash
+
+
+def run_schedule(price_matrix, rows, actions, symbol_idxs, amounts, cash, shares, cost_basis, avg_cost, values):
+    """Applies a row-sorted schedule of deposits and trades, recording cash plus holdings value at every row into values and returning the remaining cash."""
+
+    n = 0
+
+    for row in range(price_matrix.shape[0]):
+        # every scheduled entry for this row, same rules as the matching Portfolio methods
+        while n < rows.shape[0] and rows[n] == row:
+            action = actions[n]
+            i = symbol_idxs[n]
+            amount = amounts[n]
+            price = price_matrix[row, i]
+
+            if action == DEPOSIT:
+                cash += amount
+            elif action == SELL:
+                quantity = int(amount)
+                if 0 < quantity <= shares[i]:
+                    shares[i] -= quantity
+                    cost_basis[i] -= avg_cost[i] * quantity
+                    cash += price * quantity
+            else:
+                quantity = 0
+                if action == BUY:
+                    quantity = int(amount)
+                elif action == MAX_BUY and price > 0:
+                    quantity = int(cash // price)
+                elif action == VALUE_BUY and amount <= cash and price > 0:
+                    quantity = int(amount // price)
+
+                cost = price * quantity
+                if cash >= cost:
+                    shares[i] += quantity
+                    cost_basis[i] += cost
+                    cash -= cost
+
+                    if shares[i] > 0:
+                        avg_cost[i] = cost_basis[i] / shares[i]
+
+            n += 1
+
+        value = cash
+        for j in range(shares.shape[0]):
+            value += price_matrix[row, j] * shares[j]
+        values[row] = value
+
+    return cash
+
+
+if __name__ == '__main__':
+    from numba.pycc import CC
+
+    # python _kernels.py -> builds dca_kernels.*.so next to this file
+    cc = CC('dca_kernels')
+    cc.export('simulate_dca', 'f8(f8[:,:], i8[:], i8, f8, f8, i8[:], f8[:], f8[:])')(simulate_dca)
+    cc.export('rebalance', 'f8(f8[:], i8[:], f8, f8, i8[:], f8[:], f8[:])')(rebalance)
+    cc.export('run_schedule', 'f8(f8[:,:], i8[:], i8[:], i8[:], f8[:], f8, i8[:], f8[:], f8[:], f8[:])')(run_schedule)
+    cc.compile()
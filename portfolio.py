@@ -1,7 +1,44 @@
 # Module for the portfolio object that will be used for testing different Dollar Cost Averaging methods using different approaches to the underlying sectors.
 
 import os
-import pandas as pd
+import glob
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+# pandas is only needed to ingest the csv files, it is imported lazily so runs served from the npz cache never load it
+if TYPE_CHECKING:
+    import pandas as pd
+
+from _kernels import ACTIONS, BUY, DEPOSIT, MAX_BUY, SELL, VALUE_BUY, rebalance, run_schedule, simulate_dca
+
+# prefer the AOT-compiled kernels (built with `python _kernels.py`), then numba JIT, then plain python
+try:
+    from dca_kernels import rebalance as _rebalance, run_schedule as _run_schedule, simulate_dca as _simulate_dca
+except ImportError:
+    try:
+        from numba import njit
+        _simulate_dca = njit(cache=True)(simulate_dca)
+        _run_schedule = njit(cache=True)(run_schedule)
+        _rebalance = njit(cache=True)(rebalance)
+    except ImportError:
+        _simulate_dca = simulate_dca
+        _run_schedule = run_schedule
+        _rebalance = rebalance
+
+
+# not very modular, specific directory hard coded
+DATA_DIR = 'sector_historical'
+CACHE_PATH = 'sector_historical.npz'
+
+
+def read_prices(path: str) -> 'pd.DataFrame':
+    """Reads the dates and opening prices from a csv of historical price data."""
+
+    import pandas as pd
+
+    # only the date and opening price are ever used
+    return pd.read_csv(path, usecols=['Unnamed: 0', 'open'], dtype={'open': np.float64}, parse_dates=['Unnamed: 0'])
 
 
 class Portfolio:
@@ -9,81 +46,97 @@ class Portfolio:
     def __init__(self, cash: float = 100000, start_date = '2001-01-01', end_date = '2021-01-01') -> None:
         """Constructor for Portfolio instance."""
         
-        self.portfolio = dict()
         self.cash = cash
-        self.data = self.load_data()
+        self.load_data()
         self.deposit_track = cash
 
-        # not modular, picked random symbol because we know all elements have same timeframe
-        self.datelist = self.data['XLB']['Unnamed: 0'].tolist()
+        # holdings stored as parallel arrays aligned with the columns of self.price_matrix
+        self.active = np.zeros(len(self.symbols), dtype=bool)
+        self.shares = np.zeros(len(self.symbols), dtype=np.int64)
+        self.cost_basis = np.zeros(len(self.symbols), dtype=np.float64)
+
+        # average cost per share, only changes on purchases so sales need no division
+        self.avg_cost = np.zeros(len(self.symbols), dtype=np.float64)
+
+        # price matrix columns of the symbols currently in the portfolio, in the order they were added
+        self.held_idx = np.zeros(0, dtype=np.int64)
+        self.held_symbols = ()
 
 
     def add(self, symbol: str) -> None:
         """Add a symbol to the portfolio at specified share count and cost."""
 
-        # checking for key to prevent overwriting
-        if symbol in self.portfolio:
+        i = self.symbol_idx[symbol]
+
+        # checking for holding to prevent overwriting
+        if self.active[i]:
             return
 
-        # writing new element to portfolio
-        self.portfolio[symbol] = {
-            'shares': 0,
-            'cost': 0.00
-        }
+        # marking the symbol's column as held
+        self.active[i] = True
+        self.held_idx = np.append(self.held_idx, i)
+        self.held_symbols += (symbol,)
 
 
     def remove(self, symbol: str) -> None:
         """Remove a symbol and its data from the portfolio."""
 
-        try:
-            del self.portfolio[symbol]
-        except:
+        i = self.symbol_idx.get(symbol)
+
+        if i is None or not self.active[i]:
             return
 
+        self.active[i] = False
+        self.shares[i] = 0
+        self.cost_basis[i] = 0.00
+        self.avg_cost[i] = 0.00
+        self.held_idx = self.held_idx[self.held_idx != i]
+        self.held_symbols = tuple(s for s in self.held_symbols if s != symbol)
+
 
     def buy(self, symbol: str, date: str) -> None:
         """Purchase single share of given symbol."""
 
-        cost = self.get_price(symbol, date)
-
-        if self.cash >= cost:
-            self.portfolio[symbol]['shares'] += 1
-            self.portfolio[symbol]['cost'] += cost
-            self.cash -= cost
+        self.bulk_buy(symbol, 1, date)
 
 
     def sell(self, symbol: str, date: str) -> None:
         """Sell single share of given symbol."""
 
-        price = self.get_price(symbol, date)
-
-        if symbol in self.portfolio.keys():
-            if self.portfolio[symbol]['shares'] >= 1:
-                avg_cost = self.portfolio[symbol]['cost'] / self.portfolio[symbol]['shares']
-                self.portfolio[symbol]['shares'] -= 1
-                self.portfolio[symbol]['cost'] -= avg_cost
-                self.cash += price
+        self.bulk_sell(symbol, 1, date)
 
 
     def bulk_buy(self, symbol: str, quantity: int, date: str) -> None:
         """Update portfolio with new share count and cost after purchase of given quantity of shares."""
 
-        price = self.get_price(symbol, date)
+        self.bulk_buy_at(symbol, quantity, self.get_price(symbol, date))
+
+
+    def bulk_buy_at(self, symbol: str, quantity: int, price: float) -> None:
+        """Purchase given quantity of shares at an already known price."""
+
         cost = price * quantity
 
         if self.cash >= cost:
-            self.portfolio[symbol]['shares'] += quantity
-            self.portfolio[symbol]['cost'] += cost
+            i = self.get_holding_idx(symbol)
+            shares = self.shares[i] + quantity
+            cost_basis = self.cost_basis[i] + cost
+
+            self.shares[i] = shares
+            self.cost_basis[i] = cost_basis
             self.cash -= cost
 
+            if shares > 0:
+                self.avg_cost[i] = cost_basis / shares
+
 
     def max_buy(self, symbol: str, date: str) -> None:
         """Purchase the maximum number of shares possible until cash exhausted."""
 
         price = self.get_price(symbol, date)
-        quantity = int(self.cash / price)
+        quantity = int(self.cash // price) if price > 0 else 0
 
-        self.bulk_buy(symbol, quantity, date)
+        self.bulk_buy_at(symbol, quantity, price)
 
 
     def value_buy(self, symbol: str, amount: float, date: str) -> None:
@@ -94,9 +147,9 @@ class Portfolio:
             return
 
         price = self.get_price(symbol, date)
-        quantity = int(amount / price)
+        quantity = int(amount // price) if price > 0 else 0
 
-        self.bulk_buy(symbol, quantity, date)
+        self.bulk_buy_at(symbol, quantity, price)
 
 
     def bulk_sell(self, symbol: str, quantity: int, date: str) -> None:
@@ -104,27 +157,75 @@ class Portfolio:
 
         price = self.get_price(symbol, date)
 
-        if symbol in self.portfolio.keys():
-            if self.portfolio[symbol]['shares'] >= quantity:
-                avg_cost = self.portfolio[symbol]['cost'] / self.portfolio[symbol]['shares']
-                self.portfolio[symbol]['shares'] -= quantity
-                self.portfolio[symbol]['cost'] -= avg_cost * quantity
+        # single probe for the column, then the holding is read once
+        i = self.symbol_idx.get(symbol)
+
+        if i is not None and self.active[i]:
+            shares = self.shares[i]
+            if 0 < quantity <= shares:
+                self.shares[i] = shares - quantity
+                self.cost_basis[i] -= self.avg_cost[i] * quantity
                 self.cash += price * quantity
 
 
     def max_sell(self, symbol: str, date: str) -> None:
         """Sell all shares from holdings of a given symbol."""
 
-        quantity = self.portfolio[symbol]['shares']
+        quantity = self.get_share_count(symbol)
 
         self.bulk_sell(symbol, quantity, date)
         # could optionally add self.remove(symbol)
 
 
+    def dca(self, symbol: str, dates, deposit: float = 0.00) -> None:
+        """Deposits the given amount and purchases the maximum number of shares of symbol at every date, in a single compiled pass."""
+
+        schedule_idxs = self.get_date_rows(dates)
+
+        self.deposit_track += deposit * len(schedule_idxs)
+        self.cash = float(_simulate_dca(
+            self.price_matrix, schedule_idxs, self.get_holding_idx(symbol), float(deposit), float(self.cash),
+            self.shares, self.cost_basis, self.avg_cost
+        ))
+
+
+    def run(self, dates, actions, symbols, amounts) -> np.ndarray:
+        """
+        Applies a whole schedule of deposits and trades in a single compiled pass.
+        Each entry is (date, action, symbol, amount) with action one of DEPOSIT, BUY, SELL (amount = share quantity),
+        MAX_BUY or VALUE_BUY (amount = cash); the symbol is ignored for deposits.
+        Returns the value of cash plus holdings at every date in datelist.
+        """
+
+        rows = self.get_date_rows(dates)
+        actions = np.asarray(actions, dtype=np.int64)
+        amounts = np.asarray(amounts, dtype=np.float64)
+
+        if not np.isin(actions, ACTIONS).all():
+            raise ValueError(f'Unknown schedule action, expected one of {ACTIONS}')
+
+        symbol_idxs = np.array(
+            [0 if action == DEPOSIT else self.get_holding_idx(symbol) for action, symbol in zip(actions.tolist(), symbols)],
+            dtype=np.int64
+        )
+
+        # the kernel walks the schedule alongside the dates so it must be in date order
+        order = np.argsort(rows, kind='stable')
+        values = np.empty(len(self.datelist))
+
+        self.deposit_track += float(amounts[actions == DEPOSIT].sum())
+        self.cash = float(_run_schedule(
+            self.price_matrix, rows[order], actions[order], symbol_idxs[order], amounts[order],
+            float(self.cash), self.shares, self.cost_basis, self.avg_cost, values
+        ))
+
+        return values
+
+
     def even_balance(self, date: str) -> None:
         """Gives equal weight to all elements of the portfolio."""
 
-        weight = 1 / len(self.portfolio.keys())
+        weight = 1 / len(self.held_idx)
 
         self.balance_portfolio(weight, date)
 
@@ -134,61 +235,39 @@ class Portfolio:
         # weight given as decimal (Ex: 0.1 instead of 10)
     
         # checking that weight is possible with size of portfolio
-        if weight * len(self.portfolio.keys()) > 100:
+        if weight * len(self.held_idx) > 100:
             print('weight too large, breaking...')
             return
 
+        # one price row for the date shared by every step below
+        row = self.price_matrix[self.get_date_row(date)]
+        held = self.held_idx
+        prices = row[held]
+
         # cash value of weight percentage relative to total value of portfolio and cash
-        weight_cost = (self.cash + self.get_holdings_value(date)) * weight
+        weight_cost = (self.cash + float(prices @ self.shares[held])) * weight
 
-        # highest price stock in portfolio
-        min_price = self.find_most_expensive(date)
+        # highest price stock in portfolio, taken from the same row rather than another find_most_expensive lookup
+        min_price = float(prices.max(initial=0))
 
         # can we afford to buy atleast 1 share of most expensive stock?
         if weight_cost < min_price:
             print('Weight percentage requires too small quantity of cash making rebalancing impossible.')
             return
 
-        # for tracking holdings that need more shares. They will be done after selling off extra shares to ensure there is enough cash available
-        need_purchase = []
-
-        # checking all funds in holdings and selling off shares until weight is met from above
-        for fund in self.portfolio.keys():
-            shares = self.get_share_count(fund)
-            price = self.get_price(fund, date)
-            value = price * shares
-
-            # if there is room for an additional share or more, store reference for rehandling
-            if (value + price) <= weight_cost:
-                need_purchase.append(fund)
-            # if the value exceeds weight_cost, determine number of shares to sell and call bulk_sell
-            else:
-                quantity = int((value - weight_cost) / price)
-                self.bulk_sell(fund, quantity, date)
-
-        # handling holdings that need additional shares
-        for fund in need_purchase:
-            shares = self.get_share_count(fund)
-            price = self.get_price(fund, date)
-            value = price * shares
-
-            # determining how many shares must be bought to roughly match weight_cost
-            quantity = int((weight_cost - value) / price)
-
-            # purchasing needed number of shares
-            self.bulk_buy(fund, quantity, date)
+        # selling and buying every holding towards weight_cost in a single compiled pass
+        self.cash = float(_rebalance(
+            row, held, float(weight_cost), float(self.cash),
+            self.shares, self.cost_basis, self.avg_cost
+        ))
 
 
     def get_holdings_value(self, date: str) -> float:
         """Determine and return the cash value of all holdings in the porfolio."""
 
-        total = 0
-
-        for fund in self.portfolio.keys():
-            shares = self.portfolio[fund]['shares']
-            total += shares * self.get_price(fund, date)
-
-        return total
+        # single dot product of the held prices for the date against their share counts
+        row = self.price_matrix[self.get_date_row(date)]
+        return float(row[self.held_idx] @ self.shares[self.held_idx])
 
 
     def get_portfolio_value(self, date: str) -> float:
@@ -198,86 +277,179 @@ class Portfolio:
 
 
     def find_most_expensive(self, date: str) -> float:
-        """Returns the element of the portfolio which has the highest stock price for validating weight ratio."""
+        """Returns the highest stock price among the elements of the portfolio (0 if empty) for validating weight ratio."""
 
-        max_price = 0
-
-        for fund in self.portfolio.keys():
-            price = self.get_price(fund, date)
-            if price > max_price:
-                max_price = price
-
-        return max_price
+        # max over the held columns of the date's price row, 0 for an empty portfolio
+        return float(self.price_matrix[self.get_date_row(date), self.held_idx].max(initial=0))
 
 
     def get_price(self, symbol: str, date: str) -> float:
         """
         Find and return the historical price of a ticker pulled from stored data.
-        Date format: YYYY-MM-DD
+        Date format: YYYY-MM-DD or int days since epoch (as found in datelist)
         """
 
-        # locating the dataframe is self.data
-        df = self.find_data(symbol)
-        
         # attempting to locate and return the opening price at the given date
         try:
-            row = df.loc[df['Unnamed: 0'] == date]
-            return list(row['open'])[0] # sketchy way to parse price out of series
-        # if price not found, returns -1 as sentinel value
-        except:
-            print(f'Could not locate price for {symbol} at the given date, returning -1...')
-            ValueError
+            return float(self.price_matrix[self.get_date_row(date), self.symbol_idx[symbol]])
+        # unknown symbol or date outside the data
+        except KeyError:
+            raise ValueError(f'Could not locate price for {symbol} at {date}') from None
 
 
     def low_performer(self, start_date: str, end_date: str) -> str:
         """Determines which element of the portfolio performed the worst from start_date to end_date (inclusive)."""
 
-        stats = dict()
+        changes = self.get_period_changes(start_date, end_date)
 
-        for fund in self.portfolio.keys():
-            start = self.get_price(fund, start_date)
-            end = self.get_price(fund, end_date)
-            change = (end - start) / start
-            stats[fund] = change
-        
-        return min(stats, key=stats.get)
+        return self.held_symbols[np.argmin(changes)]
 
 
     def high_performer(self, start_date: str, end_date: str) -> str:
         """Determines which element of the portfolio performed the best from start_date to end_date (inclusive)."""
 
-        stats = dict()
+        changes = self.get_period_changes(start_date, end_date)
+
+        return self.held_symbols[np.argmax(changes)]
+
+
+    def get_period_changes(self, start_date: str, end_date: str) -> np.ndarray:
+        """Returns the fractional price change of every element of the portfolio from start_date to end_date, in held order."""
+
+        start = self.price_matrix[self.get_date_row(start_date), self.held_idx]
+        end = self.price_matrix[self.get_date_row(end_date), self.held_idx]
+
+        return (end - start) / start
 
-        for fund in self.portfolio.keys():
-            start = self.get_price(fund, start_date)
-            end = self.get_price(fund, end_date)
-            change = (end - start) / start
-            stats[fund] = change
 
-        return max(stats, key=stats.get)
+    def load_data(self) -> None:
+        """Loads the historical price data into the price matrix, from the npz cache when it is newer than the csv files."""
 
+        # cheap invalidation check, any csv (or the directory listing) touched after the cache was written forces a reparse
+        paths = sorted(glob.glob(f'{DATA_DIR}/*.csv'))
+        data_mtime = max([os.path.getmtime(DATA_DIR)] + [os.path.getmtime(path) for path in paths])
 
-    def load_data(self) -> dict:
-        """Loads the csv type historical price data into a dict of references."""
+        if os.path.exists(CACHE_PATH) and os.path.getmtime(CACHE_PATH) >= data_mtime:
+            with np.load(CACHE_PATH) as cache:
+                self.price_matrix = cache['price']
+                self.symbols = cache['symbols'].tolist()
+                self.datelist = cache['dates']
+        else:
+            self.load_csv_data(paths)
+            self.save_cache()
 
-        data = dict()
+        self.symbol_idx = {s: i for i, s in enumerate(self.symbols)}
 
-        # not very modular, specific directory hard coded
-        for csv in os.listdir('sector_historical'):
-            df = pd.read_csv(f'sector_historical/{csv}')
-            name = csv[:-4] # remove '.csv'
-            data[name] = df # add to data
+        # dense day offset -> row table over the whole date span, -1 marks weekends, holidays and other gaps
+        self.date_to_row = np.full(self.datelist[-1] - self.datelist[0] + 1, -1, dtype=np.int64)
+        self.date_to_row[self.datelist - self.datelist[0]] = np.arange(len(self.datelist))
 
-        return data
+        # 'YYYY-MM-DD' -> row, filled lazily by get_date_row
+        self.date_cache = dict()
 
 
-    def find_data(self, symbol: str) -> pd.DataFrame:
-        """Finds and returns the dataframe for a given symbol in self.data."""
+    def load_csv_data(self, paths: list) -> None:
+        """Parses the csv type historical price data into the price matrix."""
+
+        names = [os.path.basename(path)[:-4] for path in paths] # remove '.csv'
+
+        # pandas releases the GIL while parsing so the files are read concurrently
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            data = dict(zip(names, ex.map(read_prices, paths)))
+
+        # not modular, picked random symbol because we know all elements have same timeframe
+        dates = data['XLB']['Unnamed: 0']
+
+        # dates as int64 days since epoch are used as the primary key from here on
+        self.datelist = dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+
+        # opening prices of every symbol stacked into a single (dates x symbols) matrix
+        self.symbols = sorted(data)
+        self.price_matrix = np.column_stack([
+            data[s].set_index('Unnamed: 0')['open'].reindex(dates).to_numpy()
+            for s in self.symbols
+        ])
+
+
+    def save_cache(self) -> None:
+        """Writes the price matrix, symbols and dates to the npz cache, skipped if the location is not writable."""
+
+        # written to a temporary file and moved into place so a concurrent reader never sees a partial cache
+        tmp_path = f'{CACHE_PATH}.{os.getpid()}.tmp'
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, price=self.price_matrix, symbols=np.array(self.symbols), dates=self.datelist)
+            os.replace(tmp_path, CACHE_PATH)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
 
-        # linear search for dataframe and return
-        for key in self.data.keys():
-            if key == symbol:
-                return self.data[key]
+    def get_date_row(self, date) -> int:
+        """Returns the price matrix row for a date given as 'YYYY-MM-DD' or as int days since epoch."""
+
+        # string dates are parsed on first use only, data is immutable after loading so no invalidation needed
+        if isinstance(date, str):
+            row = self.date_cache.get(date)
+            if row is None:
+                try:
+                    row = self.get_date_row(int(np.datetime64(date, 'D').astype(np.int64)))
+                except KeyError:
+                    raise KeyError(date) from None
+                self.date_cache[date] = row
+            return row
+
+        offset = date - self.datelist[0]
+        row = self.date_to_row[offset] if 0 <= offset < len(self.date_to_row) else -1
+
+        if row < 0:
+            raise KeyError(date)
+
+        return int(row)
+
+
+    def get_date_rows(self, dates) -> np.ndarray:
+        """Vectorized get_date_row for a sequence of dates, all given as 'YYYY-MM-DD' or all as int days since epoch."""
+
+        offsets = np.asarray(dates, dtype='datetime64[D]').astype(np.int64) - self.datelist[0]
+        in_range = (offsets >= 0) & (offsets < len(self.date_to_row))
+        rows = np.where(in_range, self.date_to_row[np.where(in_range, offsets, 0)], -1)
+
+        if (rows < 0).any():
+            raise KeyError(np.asarray(dates)[rows < 0].tolist()[0])
+
+        return rows
+
+
+    def find_data(self, symbol: str) -> 'pd.DataFrame':
+        """Builds and returns a dataframe of the dates and opening prices for a given symbol."""
+
+        import pandas as pd
+
+        return pd.DataFrame({
+            'Unnamed: 0': self.datelist.astype('datetime64[D]'),
+            'open': self.price_matrix[:, self.symbol_idx[symbol]]
+        })
+
+
+    def is_held(self, symbol: str) -> bool:
+        """Checks whether a symbol is currently part of the portfolio."""
+
+        i = self.symbol_idx.get(symbol)
+
+        return i is not None and bool(self.active[i])
+
+
+    def get_holding_idx(self, symbol: str) -> int:
+        """Returns the price matrix column of a symbol held in the portfolio, KeyError if it is not held."""
+
+        i = self.symbol_idx.get(symbol)
+
+        if i is None or not self.active[i]:
+            raise KeyError(symbol)
+
+        return i
 
 
     def deposit(self, amount: float) -> None:
@@ -295,13 +467,17 @@ class Portfolio:
     def get_share_count(self, symbol: str) -> int:
         """Accessor for share count of symbol."""
 
-        return self.portfolio[symbol]['shares']
+        return int(self.shares[self.get_holding_idx(symbol)])
 
 
     def get_portfolio(self) -> dict:
         """Accessor for portfolio."""
 
-        return self.portfolio
+        # synthesized from the holdings arrays on demand
+        return {
+            symbol: {'shares': int(self.shares[i]), 'cost': float(self.cost_basis[i]), 'avg_cost': float(self.avg_cost[i])}
+            for symbol, i in zip(self.held_symbols, self.held_idx)
+        }
 
 
     def get_cash(self) -> float:
@@ -310,7 +486,7 @@ class Portfolio:
         return self.cash
 
 
-    def get_datelist(self) -> list:
-        """Accessor for datelist."""
+    def get_datelist(self) -> np.ndarray:
+        """Accessor for datelist (int64 days since epoch)."""
 
         return self.datelist
\ No newline at end of file
@@ -2,11 +2,11 @@ from portfolio import Portfolio
 import pandas as pd
 import datetime as dt
 
-# df = pd.read_csv('sector_historical/XLB.csv')
+# df = pd.read_csv('sector_historical/XLB.csv', index_col=0, parse_dates=True)
 
-# print(df['Unnamed: 0'].tolist())
+# print(df.index.tolist())
 
-# row = df.loc[df['Unnamed: 0'] == '2001-01-02']
+# row = df.loc['2001-01-02']
 
 # portfolio = Portfolio()
 